@@ -0,0 +1,72 @@
+from datetime import datetime
+
+TOOL_DEFINITIONS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "schedule_meeting",
+            "description": "Schedules a meeting with specified attendees at a given date and time. Use today's date if the user doesn't specify one.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "attendees": {"type": "array", "items": {"type": "string"},
+                                  "description": "List of people to invite."},
+                    "date": {"type": "string", "description": "The date of the meeting in YYYY-MM-DD format."},
+                    "time": {"type": "string", "description": "The time of the meeting in HH:MM format."},
+                    "topic": {"type": "string", "description": "The subject or topic of the meeting."},
+                },
+                "required": ["attendees", "date", "time", "topic"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_weather",
+            "description": "Gets the current weather for a specific city.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "city": {"type": "string", "description": "The city name, e.g., 'San Francisco'."},
+                    "units": {"type": "string", "enum": ["metric", "imperial"], "default": "metric"},
+                },
+                "required": ["city"],
+            },
+        },
+    },
+]
+
+
+_WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+_MONTHS = ("January", "February", "March", "April", "May", "June",
+           "July", "August", "September", "October", "November", "December")
+
+
+def schedule_meeting(attendees, date, time, topic):
+    try:
+        # Fixed-position YYYY-MM-DD / HH:MM fields; datetime() rejects out-of-range values.
+        # isascii() too: isdigit() alone accepts non-ASCII digits such as "２" or "٣".
+        if not (len(date) == 10 and date.isascii() and date[4] == date[7] == "-"
+                and date[0:4].isdigit() and date[5:7].isdigit() and date[8:10].isdigit()):
+            raise ValueError(f"Invalid YYYY-MM-DD date: {date!r}")
+        if not (len(time) == 5 and time.isascii() and time[2] == ":"
+                and time[0:2].isdigit() and time[3:5].isdigit()):
+            raise ValueError(f"Invalid HH:MM time: {time!r}")
+        dt = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(time[0:2]), int(time[3:5]))
+        attendee_str = ", ".join(attendees)
+        when = f"{_WEEKDAYS[dt.weekday()]}, {_MONTHS[dt.month - 1]} {dt.day:02d} at {dt.hour:02d}:{dt.minute:02d}"
+        return f"Meeting '{topic}' successfully scheduled for {when} with {attendee_str}."
+    except (ValueError, TypeError) as e:
+        return f"Error scheduling meeting: Invalid date or time format. Details: {e}"
+
+
+def fetch_weather(city, units="metric"):
+    temp = 22 if units == "metric" else 72
+    unit_label = "°C" if units == "metric" else "°F"
+    return f"🌤️ The current temperature in {city} is {temp}{unit_label}."
+
+
+FUNCTION_IMPLEMENTATIONS = {
+    "schedule_meeting": schedule_meeting,
+    "fetch_weather": fetch_weather,
+}
@@ -1,74 +1,113 @@
 import json
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
+import os
+import queue
 import sys
-from llama_cpp import Llama
+import threading
+from time import monotonic
+
+# Snapshot the CPUs this process may use (e.g. as restricted by taskset/numactl) before
+# llama_cpp loads: with OMP_PROC_BIND set, libgomp pins the loading thread to one core.
+_ALLOWED_CPUS = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+
+# Keep llama.cpp's OpenMP workers on one core each instead of letting the scheduler
+# migrate them (and their caches) across cores. Must be set before llama_cpp loads.
+os.environ.setdefault("OMP_PROC_BIND", "close")
+os.environ.setdefault("OMP_PLACES", "cores")
+import llama_cpp
+
+if _ALLOWED_CPUS is not None:
+    # Undo libgomp's load-time pin of this thread; Flask's request threads inherit its mask.
+    os.sched_setaffinity(0, _ALLOWED_CPUS)
+from llama_cpp import Llama, LlamaGrammar
 from huggingface_hub import hf_hub_download
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS  # Import CORS
+from llmfunctions import TOOL_DEFINITIONS, FUNCTION_IMPLEMENTATIONS
+
+try:
+    import orjson  # Optional: faster parsing of tool calls and encoding of responses.
+except ImportError:
+    orjson = None
+
+# _json_body returns a response body (bytes with orjson, so Flask sends it without re-encoding);
+# _json_dumps returns str for embedding in SSE frames.
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_body = orjson.dumps
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    _json_loads = json.loads
+    _json_body = json.dumps
+    _json_dumps = json.dumps
 
 # --- All your existing agent code ---
 MODEL_DIR = Path("./models")
 MODEL_REPO = "TheBloke/Phi-3-mini-4k-instruct-GGUF"
 MODEL_FILENAME = "Phi-3-mini-4k-instruct.Q4_K_M.gguf"
 MODEL_PATH = MODEL_DIR / MODEL_FILENAME
+RESPONSE_CACHE_SIZE = 512
+# Cached answers expire quickly because the system prompt carries the current time:
+# "in two hours" or "what time is it" must not replay an answer from earlier in the day.
+RESPONSE_CACHE_TTL = 60  # seconds
 
-TOOL_DEFINITIONS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "schedule_meeting",
-            "description": "Schedules a meeting with specified attendees at a given date and time. Use today's date if the user doesn't specify one.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "attendees": {"type": "array", "items": {"type": "string"},
-                                  "description": "List of people to invite."},
-                    "date": {"type": "string", "description": "The date of the meeting in YYYY-MM-DD format."},
-                    "time": {"type": "string", "description": "The time of the meeting in HH:MM format."},
-                    "topic": {"type": "string", "description": "The subject or topic of the meeting."},
-                },
-                "required": ["attendees", "date", "time", "topic"],
-            },
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "fetch_weather",
-            "description": "Gets the current weather for a specific city.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "city": {"type": "string", "description": "The city name, e.g., 'San Francisco'."},
-                    "units": {"type": "string", "enum": ["metric", "imperial"], "default": "metric"},
-                },
-                "required": ["city"],
-            },
-        },
-    },
-]
-
-
-def schedule_meeting(attendees, date, time, topic):
-    try:
-        dt = datetime.fromisoformat(f"{date}T{time}")
-        attendee_str = ", ".join(attendees)
-        return f" Meeting '{topic}' successfully scheduled for {dt.strftime('%A, %B %d at %H:%M')} with {attendee_str}."
-    except (ValueError, TypeError) as e:
-        return f"Error scheduling meeting: Invalid date or time format. Details: {e}"
+
+def _describe_tools(tools):
+    return "\n".join(
+        f"\nTool: {tool['function']['name']}\n"
+        f"Description: {tool['function']['description']}\n"
+        f"Parameters (JSON Schema): {json.dumps(tool['function']['parameters'], indent=2)}"
+        for tool in tools
+    )
+
+
+_TOOL_DESCRIPTIONS = _describe_tools(TOOL_DEFINITIONS)
+
+# Either a well-formed tool call (the `name` rule is generated from the tool list)
+# or plain prose that does not start with "{". Tool calls can then never be malformed.
+_TOOL_CALL_GRAMMAR = r"""
+root   ::= call | prose
+call   ::= "{" ws "\"name\"" ws ":" ws name ws "," ws "\"arguments\"" ws ":" ws object ws "}"
+prose  ::= [^{ \t\n] [^\x00]*
+value  ::= object | array | string | number | "true" | "false" | "null"
+object ::= "{" ws ( string ws ":" ws value ( ws "," ws string ws ":" ws value )* )? ws "}"
+array  ::= "[" ws ( value ( ws "," ws value )* )? ws "]"
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\""
+number ::= "-"? [0-9]+ ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )?
+ws     ::= [ \t\n]*
+"""
+
+
+def _tool_call_grammar(tools):
+    names = " | ".join(json.dumps(json.dumps(tool["function"]["name"])) for tool in tools)
+    return LlamaGrammar.from_string(f"{_TOOL_CALL_GRAMMAR}name   ::= {names}\n", verbose=False)
 
 
-def fetch_weather(city, units="metric"):
-    temp = 22 if units == "metric" else 72
-    unit_label = "°C" if units == "metric" else "°F"
-    return f"🌤️ The current temperature in {city} is {temp}{unit_label}."
+def _physical_cores():
+    """Counts the physical cores in the CPU set this process was started with."""
+    if _ALLOWED_CPUS is None:
+        return os.cpu_count() or 1
+    cores = set()
+    for cpu in _ALLOWED_CPUS:
+        # Hyperthreads of one core share a sibling list; decode gains nothing from them.
+        siblings = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        cores.add(siblings.read_text().strip() if siblings.is_file() else str(cpu))
+    return len(cores)
 
 
-FUNCTION_IMPLEMENTATIONS = {
-    "schedule_meeting": schedule_meeting,
-    "fetch_weather": fetch_weather,
-}
+def _device_settings():
+    """Offloads every layer when llama-cpp-python was built with CUDA/Metal, else runs on CPU."""
+    if llama_cpp.llama_supports_gpu_offload():
+        # The CPU only tokenizes and samples once all layers live on the GPU.
+        return {"n_gpu_layers": -1, "main_gpu": 0, "offload_kqv": True, "n_threads": 2, "n_threads_batch": 2}
+    # Prefill gets the same count; llama-cpp-python's default for it ignores the affinity mask.
+    n_threads = _physical_cores()
+    numa_nodes = list(Path("/sys/devices/system/node").glob("node[0-9]*"))
+    return {"n_threads": n_threads, "n_threads_batch": n_threads, "numa": len(numa_nodes) > 1}
 
 
 class FunctionCallingAgent:
@@ -76,18 +115,37 @@ class FunctionCallingAgent:
         self.model_path = Path(model_path)
         self.tools = tools
         self.function_implementations = function_implementations
+        # A single llama.cpp context cannot decode two requests at once.
+        self._lock = threading.Lock()
+        # Raw model output per user message, so repeated questions skip decoding.
+        self._response_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
         self._ensure_model_exists()
         print("Initializing model... (This may take a few moments)")
         self.llm = Llama(
             model_path=str(self.model_path),
             chat_format="chatml",
             n_ctx=4096,
-            n_threads=6,
+            n_batch=512,
+            n_ubatch=256,
+            # Q8_0 KV cache halves the bytes streamed per decoded token versus F16.
+            # llama.cpp only accepts a quantized V cache with flash attention.
+            type_k=llama_cpp.GGML_TYPE_Q8_0,
+            type_v=llama_cpp.GGML_TYPE_Q8_0,
+            flash_attn=True,
+            # Weights are mmap'd read-only, so every process serving this model shares one
+            # copy through the page cache. mlock is left off so that still holds without a
+            # raised RLIMIT_MEMLOCK per process.
+            use_mmap=True,
+            use_mlock=False,
             verbose=False,
+            **_device_settings(),
         )
-        print("Model initialized successfully.")
         self.system_prompt = self._create_system_prompt()
-        self.chat_history = [{"role": "system", "content": self.system_prompt}]
+        self.tool_grammar = _tool_call_grammar(self.tools)
+        self._prime_system_prompt()
+        self._warm_up()
+        print("Model initialized successfully.")
 
     def _ensure_model_exists(self):
         if not self.model_path.is_file():
@@ -106,64 +164,168 @@ class FunctionCallingAgent:
                 sys.exit(1)
 
     def _create_system_prompt(self):
-        # ... (This function is unchanged)
+        # The rules and tool schemas never change, so this part is built (and its
+        # tokens evaluated) once. The timestamp is appended per chat, see chat().
+        tool_descriptions = _TOOL_DESCRIPTIONS if self.tools is TOOL_DEFINITIONS else _describe_tools(self.tools)
         prompt_parts = [
             "You are a helpful assistant that strictly follows instructions to call functions.",
-            f"The current date and time is: {datetime.now().isoformat()}",
             "\n--- RULES ---",
             "1. You MUST call a tool when the user's request can be fulfilled by one of the available tools.",
             "2. When you decide to call a tool, you MUST respond in the format of a JSON object.",
             "3. The JSON object MUST contain \"name\" (the tool name) and \"arguments\" (a sub-object with parameters).",
             "4. Your response MUST ONLY contain the JSON object and nothing else. Do not add any conversational text, explanations, or apologies before or after the JSON.",
-            "\n--- AVAILABLE TOOLS ---"
+            "\n--- AVAILABLE TOOLS ---",
+            tool_descriptions,
+            "\n--- END OF TOOLS ---",
         ]
-        for tool in self.tools:
-            func = tool['function']
-            prompt_parts.append(
-                f"\nTool: {func['name']}\n"
-                f"Description: {func['description']}\n"
-                f"Parameters (JSON Schema): {json.dumps(func['parameters'], indent=2)}"
-            )
-        prompt_parts.append("\n--- END OF TOOLS ---")
         return "\n".join(prompt_parts)
 
-    def chat(self, user_query):
+    def _prime_system_prompt(self):
+        """Evaluates the system prompt once so even the first request finds it in the KV cache."""
+        # Same prefix the chatml formatter emits for the system message. Later completions
+        # match it (and every previous request's system prompt) as their longest common
+        # prefix, so only the tokens after it are prefilled.
+        prefix = f"<|im_start|>system\n{self.system_prompt}"
+        tokens = self.llm.tokenize(prefix.encode("utf-8"), add_bos=True, special=True)
+        self.llm.reset()
+        self.llm.eval(tokens)
+
+    def _warm_up(self):
+        """Runs a single-token decode so the first request does not pay for it."""
+        # Priming the system prompt already faulted in every weight page with a batched
+        # forward pass; this also sets up the one-token decode path used while generating.
+        # The extra token falls outside the system prompt prefix, so the first request drops it.
+        self.llm.eval(self.llm.tokenize(b" ", add_bos=False))
+
+    def _complete(self, user_query, stream=False):
+        """Runs the completion for one user turn. Callers must hold self._lock."""
         # This is kept mostly the same, but we will reset history for each API call
         # for a stateless API. If you want to maintain session state, this would need adjustment.
+        system_prompt = f"{self.system_prompt}\nThe current date and time is: {datetime.now().isoformat()}"
         chat_session = [
-            {"role": "system", "content": self.system_prompt},
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_query}
         ]
 
-        response = self.llm.create_chat_completion(
+        return self.llm.create_chat_completion(
             messages=chat_session,
             tools=self.tools,
             tool_choice="auto",
+            grammar=self.tool_grammar,
+            # Plain greedy decoding: with top_k=1 and every other stage neutral the
+            # sampler reduces to an argmax over the logits.
             temperature=0.0,
+            top_k=1,
+            top_p=1.0,
+            min_p=0.0,
+            repeat_penalty=1.0,
+            mirostat_mode=0,
+            stream=stream,
         )
-        choice = response["choices"][0]["message"]
-        content = choice.get("content", "")
-        final_answer = None
 
-        try:
-            tool_call_data = json.loads(content)
-            if (isinstance(tool_call_data, dict) and
-                    "name" in tool_call_data and
-                    tool_call_data["name"] in self.function_implementations):
-                print(f"Bot wants to use tool: {tool_call_data['name']}")
-                fn_name = tool_call_data["name"]
-                args = tool_call_data.get("arguments", {})
-                function_to_call = self.function_implementations[fn_name]
-                final_answer = function_to_call(**args)
-            else:
-                final_answer = content
-        except (json.JSONDecodeError, TypeError):
+    def _answer(self, content):
+        """Runs the tool call in the model's output, or returns the output itself if it is text."""
+        # Under the tool-call grammar only tool calls start with "{", so text
+        # replies skip the JSON parse and the exception it would raise.
+        if not content.startswith("{"):
             print("Bot responded directly with text.")
             final_answer = content
+        else:
+            try:
+                tool_call_data = _json_loads(content)
+                function_to_call = self.function_implementations[tool_call_data["name"]]
+                args = tool_call_data["arguments"]
+            except (json.JSONDecodeError, KeyError, TypeError):
+                print("Bot responded directly with text.")
+                final_answer = content
+            else:
+                # Outside the try so errors raised by the tool itself are not mistaken for text.
+                print(f"Bot wants to use tool: {tool_call_data['name']}")
+                final_answer = function_to_call(**args)
 
         print(f"Final answer to be sent: {final_answer}")
         return final_answer
 
+    def _cached_content(self, user_query):
+        """Returns the model output cached for user_query, or None."""
+        with self._cache_lock:
+            entry = self._response_cache.get(user_query)
+            if entry is None:
+                return None
+            content, stored_at = entry
+            if monotonic() - stored_at > RESPONSE_CACHE_TTL:
+                del self._response_cache[user_query]
+                return None
+            self._response_cache.move_to_end(user_query)
+            return content
+
+    def _cache_content(self, user_query, content):
+        with self._cache_lock:
+            self._response_cache[user_query] = (content, monotonic())
+            self._response_cache.move_to_end(user_query)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+
+    def chat(self, user_query):
+        content = self._cached_content(user_query)
+        if content is None:
+            with self._lock:
+                response = self._complete(user_query)
+            choice = response["choices"][0]["message"]
+            content = choice.get("content", "")
+            self._cache_content(user_query, content)
+        return self._answer(content)
+
+    def _decode_into(self, user_query, deltas, cancelled):
+        """Streams the completion under the model lock, putting each text delta on deltas, then None.
+
+        Stops between chunks once cancelled is set. A finished decode is cached here, so it
+        is kept even if the reader has gone away.
+        """
+        parts = []
+        try:
+            with self._lock:
+                for chunk in self._complete(user_query, stream=True):
+                    if cancelled.is_set():
+                        return
+                    delta = chunk["choices"][0]["delta"].get("content")
+                    if delta:
+                        parts.append(delta)
+                        deltas.put(delta)
+            self._cache_content(user_query, "".join(parts))
+        except Exception as e:
+            deltas.put(e)
+        finally:
+            deltas.put(None)
+
+    def chat_stream(self, user_query):
+        """Yields {"delta": ...} events while text is generated, then a final {"response": ...} event."""
+        content = self._cached_content(user_query)
+        if content is None:
+            # Decode on a separate thread so the model lock is never held while the
+            # caller writes events to a (possibly slow) client.
+            deltas = queue.Queue()
+            cancelled = threading.Event()
+            threading.Thread(target=self._decode_into, args=(user_query, deltas, cancelled), daemon=True).start()
+            parts = []
+            try:
+                for delta in iter(deltas.get, None):
+                    if isinstance(delta, Exception):
+                        raise delta
+                    parts.append(delta)
+                    # The grammar makes "{" the first character of every tool call; its raw
+                    # JSON is not shown to the user, only the tool's result below.
+                    if parts[0][0] != "{":
+                        yield {"delta": delta}
+            finally:
+                # Runs when the client disconnects (the generator is closed) and stops the
+                # decode instead of letting it hold the model lock up to n_ctx tokens.
+                cancelled.set()
+            content = "".join(parts)
+        elif not content.startswith("{"):
+            yield {"delta": content}
+        yield {"response": self._answer(content)}
+
 
 # --- NEW: Flask API Implementation ---
 
@@ -181,27 +343,60 @@ agent = FunctionCallingAgent(
 print("\n✅ Agent is loaded and ready to receive requests.")
 
 
-# 3. Define the chat endpoint
-@app.route('/chat', methods=['POST'])
-def chat_endpoint():
-    """Receives a user message and returns the agent's response."""
+# 3. Define the chat endpoints
+def _read_message():
+    """Returns (message, None) for a valid request, or (None, error_response) otherwise."""
     if not request.json or 'message' not in request.json:
-        return jsonify({"error": "Invalid request: 'message' key not found in JSON payload."}), 400
+        return None, (jsonify({"error": "Invalid request: 'message' key not found in JSON payload."}), 400)
 
     user_message = request.json['message']
     print(f"\nReceived message: '{user_message}'")
 
     if not user_message.strip():
-        return jsonify({"error": "Message cannot be empty."}), 400
+        return None, (jsonify({"error": "Message cannot be empty."}), 400)
+    return user_message, None
+
+
+@app.route('/chat', methods=['POST'])
+def chat_endpoint():
+    """Receives a user message and returns the agent's response."""
+    user_message, error = _read_message()
+    if error:
+        return error
 
     try:
         bot_response = agent.chat(user_message)
-        return jsonify({"response": bot_response})
+        return app.response_class(_json_body({"response": bot_response}), mimetype="application/json")
     except Exception as e:
         print(f"An error occurred during chat processing: {e}")
         return jsonify({"error": "An internal error occurred."}), 500
 
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """Receives a user message and streams the agent's response as Server-Sent Events."""
+    user_message, error = _read_message()
+    if error:
+        return error
+
+    def events():
+        try:
+            for event in agent.chat_stream(user_message):
+                yield f"data: {_json_dumps(event)}\n\n"
+        except Exception as e:
+            print(f"An error occurred during chat processing: {e}")
+            yield f"data: {_json_dumps({'error': 'An internal error occurred.'})}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    """Reports that the server is up without waiting on the model."""
+    return jsonify({"status": "ok"})
+
+
 # 4. Run the app on a specific port (e.g., 5001) to avoid conflicts
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # No debug reloader: it re-imports this module and loads the model a second time.
+    app.run(host='0.0.0.0', port=5001)